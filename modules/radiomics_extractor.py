@@ -4,58 +4,99 @@ import nibabel as nib
 import SimpleITK as sitk
 from radiomics import featureextractor
 from pathlib import Path
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+import json
 import logging
 import os
 import re
 
+from modules.task_executor import LocalExecutor
+
 logging.getLogger("radiomics").setLevel(logging.ERROR)
 logging.getLogger("pyradiomics").setLevel(logging.ERROR)
 
 def sanitize_region_name(name):
     return re.sub(r"[^\w\s-]", "_", name)  # Remplace les caractères non alphanumériques
 
-def extract_features(image_path, mask_path=None, region_label=None, region_name=None):
-    try:
-        if not Path(image_path).exists():
-            raise FileNotFoundError(f"[ERROR] Image file not found: {image_path}")
-        image = sitk.ReadImage(str(image_path))
-
-        if mask_path:
-            if not Path(mask_path).exists():
-                raise FileNotFoundError(f"[ERROR] Mask file not found: {mask_path}")
-            mask = sitk.ReadImage(str(mask_path))
-            mask_array = sitk.GetArrayFromImage(mask)
-            if np.sum(mask_array) == 0:
-                print(f"[WARNING] Mask '{mask_path}' is empty. Skipping extraction.")
-                return {}
+# Leading columns of every radiomics CSV, followed by the feature columns
+STATUS_COLUMNS = ["region_name", "status", "error", "extraction_time_s"]
+
+@lru_cache(maxsize=2)
+def _load_atlas(atlas_path, mtime_ns):
+    # Cached per process (and per file version), so that all regions of an atlas share one load
+    return nib.load(atlas_path).get_fdata().astype(int)
+
+def extract_features(image_path, mask_path=None, region_label=None, region_name=None, atlas_path=None,
+                     atlas_label=None):
+    """
+    Extracts the radiomics features of a single region, given as a mask file, a mask array or
+    a label of an atlas file (the mask is then built here, so tasks stay small).
+
+    Returns a row with `region_name`, `status` ('ok' or 'empty') and the features. Errors are
+    raised (not swallowed) so that the executor can retry, time and report them.
+    """
+    row = {"region_name": region_name, "status": "ok"}
+
+    if not Path(image_path).exists():
+        raise FileNotFoundError(f"[ERROR] Image file not found: {image_path}")
+    image = sitk.ReadImage(str(image_path))
+
+    if atlas_path:
+        atlas_data = _load_atlas(str(atlas_path), os.stat(atlas_path).st_mtime_ns)
+        region_label = (atlas_data == atlas_label).astype(np.uint8)
+
+    if mask_path:
+        if not Path(mask_path).exists():
+            raise FileNotFoundError(f"[ERROR] Mask file not found: {mask_path}")
+        mask = sitk.ReadImage(str(mask_path))
+        mask_array = sitk.GetArrayFromImage(mask)
+        if np.sum(mask_array) == 0:
+            print(f"[WARNING] Mask '{mask_path}' is empty. Skipping extraction.")
+            row["status"] = "empty"
+    else:
+        if region_label is None:
+            raise ValueError("[ERROR] Either 'mask_path' or 'region_label' must be provided.")
+        if np.sum(region_label) == 0:
+            print(f"[WARNING] Region '{region_name}' is empty. Skipping extraction.")
+            row["status"] = "empty"
         else:
-            if region_label is None:
-                raise ValueError("[ERROR] Either 'mask_path' or 'region_label' must be provided.")
-            if np.sum(region_label) == 0:
-                print(f"[WARNING] Region '{region_name}' is empty. Skipping extraction.")
-                return {}
             mask = sitk.GetImageFromArray(np.transpose(region_label, (2, 1, 0)))
             mask.CopyInformation(image)
 
+    if row["status"] == "ok":
         extractor = featureextractor.RadiomicsFeatureExtractor()
         extractor.settings['enableDiagnostics'] = False
         extractor.settings['excludeFromFeatureClass'] = ['shape']
         features = extractor.execute(image, mask)
-        features = {k: v for k, v in features.items() if k.startswith("original")}
-
-        if region_name:
-            features["region_name"] = region_name
-
-        return features
-
-    except Exception as e:
-        print(f"[ERROR] Failed to extract radiomics for region '{region_name}': {e}")
-        return {}
-
-def process_radiomics(image_path, masks, output_csv, region_definitions=None):
+        row.update({k: v for k, v in features.items() if k.startswith("original")})
+
+    return row
+
+def failures_path(output_csv):
+    """
+    Returns the path of the failure report written next to a radiomics CSV.
+    """
+    return Path(output_csv).with_suffix(".failures.json")
+
+def process_radiomics(image_path, masks, output_csv, region_definitions=None, executor=None):
+    """
+    Extracts radiomics features for each mask and saves one row per mask, in mask order.
+
+    Args:
+        image_path: Path to the image.
+        masks: List of NIfTI mask paths, `(region_label, region_name)` tuples or
+            `{"atlas_path": ..., "label": ..., "region_name": ...}` atlas regions.
+        output_csv: Path to the output CSV.
+        executor: Executor running the region tasks (local process pool if None).
+
+    Returns:
+        Path: `output_csv`. Failed regions are kept as rows with `status` 'failed' and are
+        listed in a JSON failure report (see `failures_path`), with their `row` in the CSV.
+    """
     rows = []
     tasks = []
+    failures = []
+    image_path = str(Path(image_path).resolve())  # Tasks may run on another node or working directory
 
     for mask_config in masks:
         if isinstance(mask_config, str):
@@ -63,27 +104,54 @@ def process_radiomics(image_path, masks, output_csv, region_definitions=None):
             if not mask_path.exists():
                 raise FileNotFoundError(f"[ERROR] Mask file not found: {mask_path}")
             region_name = mask_path.stem
-            tasks.append((image_path, mask_config, None, region_name))
+            tasks.append((image_path, str(mask_path.resolve()), None, region_name, None, None))
         elif isinstance(mask_config, tuple):
             region_label, region_name = mask_config
-            tasks.append((image_path, None, region_label, region_name))
+            tasks.append((image_path, None, region_label, region_name, None, None))
+        elif isinstance(mask_config, dict):
+            tasks.append((image_path, None, None, mask_config["region_name"],
+                          str(Path(mask_config["atlas_path"]).resolve()), int(mask_config["label"])))
+
+    if executor is None:
+        executor = LocalExecutor(max_workers=8)
 
     print(f"[INFO] Starting radiomics extraction for {len(tasks)} regions or masks.")
-    max_workers = min(8, len(tasks))
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        futures = [executor.submit(extract_features, *task) for task in tasks]
-        for future in as_completed(futures):
-            try:
-                result = future.result()
-                if result:
-                    rows.append(result)
-            except Exception as e:
-                print(f"[ERROR] A task failed with error: {e}")
+    # Keys identify a region of a given image and output; the index keeps masks sharing a name distinct
+    keyed_tasks = [
+        (f"radiomics:{image_path}:{Path(output_csv).resolve()}:{index}:{task[3]}", task)
+        for index, task in enumerate(tasks)
+    ]
+    outcomes = executor.run(extract_features, keyed_tasks)
+    for (_, task), (key, result, error, elapsed) in zip(keyed_tasks, outcomes):
+        # Elapsed time of the (last) attempt, including failed ones
+        if error is None:
+            rows.append({**result, "extraction_time_s": elapsed})
+        else:
+            rows.append({"region_name": task[3], "status": "failed", "error": error, "extraction_time_s": elapsed})
+            failures.append({
+                "key": key,
+                "row": len(rows) - 1,
+                "image": image_path,
+                "region_name": task[3],
+                "mask_path": task[1],
+                "atlas_path": task[4],
+                "label": task[5],
+                "error": error,
+            })
+
+    report_path = failures_path(output_csv)
+    if failures:
+        with open(report_path, "w") as f:
+            json.dump(failures, f, indent=4)
+        print(f"[WARNING] {len(failures)} of {len(tasks)} regions failed. Failure report saved to {report_path}")
+    else:
+        report_path.unlink(missing_ok=True)
 
     if rows:
         df = pd.DataFrame(rows)
         useful_columns = [col for col in df.columns if not col.startswith(("diagnostics_", "general_"))]
-        df = df[useful_columns]
+        feature_columns = [col for col in useful_columns if col not in STATUS_COLUMNS]
+        df = df.reindex(columns=STATUS_COLUMNS + feature_columns)
         df.to_csv(output_csv, index=False)
         print(f"[INFO] Radiomics extraction completed. Results saved to {output_csv}")
     else:
@@ -91,7 +159,65 @@ def process_radiomics(image_path, masks, output_csv, region_definitions=None):
 
     return output_csv
 
-def atlas_based_radiomics(image_path, atlas_path, labels_path, output_csv):
+def retry_failed_regions(failures_json, results_csv, executor=None):
+    """
+    Re-runs only the regions listed in a failure report and updates their rows in place.
+
+    Args:
+        failures_json: Failure report (list of failed regions, each with its `row` in `results_csv`).
+        results_csv: Results CSV containing the failed rows.
+        executor: Executor running the region tasks (local process pool if None).
+
+    Returns:
+        list: Regions that failed again. The report is rewritten with them, or removed if empty.
+    """
+    with open(failures_json, "r") as f:
+        failures = json.load(f)
+
+    tasks = []
+    for failure in failures:
+        if not failure.get("mask_path") and failure.get("atlas_path") is None:
+            raise ValueError(f"[ERROR] Cannot rebuild region '{failure['region_name']}' from {failures_json}.")
+        task = (failure["image"], failure.get("mask_path"), None, failure["region_name"],
+                failure.get("atlas_path"), failure.get("label"))
+        tasks.append((f"retry:{failure['key']}:{Path(results_csv).resolve()}", task))
+
+    if executor is None:
+        executor = LocalExecutor(max_workers=8)
+
+    results = pd.read_csv(results_csv)
+    for failure in failures:
+        if results.at[failure["row"], "region_name"] != failure["region_name"]:
+            raise ValueError(f"[ERROR] Row {failure['row']} of {results_csv} does not match region "
+                             f"'{failure['region_name']}' of {failures_json}.")
+
+    print(f"[INFO] Retrying radiomics extraction for {len(tasks)} failed regions.")
+    # Always recompute: these regions are retried because their stored outcome is a failure
+    outcomes = executor.run(extract_features, tasks, reuse=False)
+    remaining = []
+    for failure, (_, result, error, elapsed) in zip(failures, outcomes):
+        row = failure["row"]
+        if error is None:
+            for column, value in result.items():
+                results.loc[row, column] = value.item() if isinstance(value, np.ndarray) else value
+            results.loc[row, "error"] = np.nan
+        else:
+            results.loc[row, "error"] = error
+            remaining.append({**failure, "error": error})
+        results.loc[row, "extraction_time_s"] = elapsed
+
+    results.to_csv(results_csv, index=False)
+    if remaining:
+        with open(failures_json, "w") as f:
+            json.dump(remaining, f, indent=4)
+        print(f"[WARNING] {len(remaining)} regions failed again. Failure report saved to {failures_json}")
+    else:
+        Path(failures_json).unlink()
+        print(f"[INFO] All failed regions were extracted. Results updated in {results_csv}")
+
+    return remaining
+
+def atlas_based_radiomics(image_path, atlas_path, labels_path, output_csv, executor=None):
     if not Path(atlas_path).exists():
         raise FileNotFoundError(f"[ERROR] The provided atlas file '{atlas_path}' does not exist.")
 
@@ -108,11 +234,13 @@ def atlas_based_radiomics(image_path, atlas_path, labels_path, output_csv):
     except Exception as e:
         raise ValueError(f"[ERROR] Failed to read labels file '{labels_path}': {e}")
 
+    # Regions are sent as (atlas, label): each task builds its own mask instead of carrying a full volume
+    present_labels = set(np.unique(atlas_data))
     regions = [
-        ((atlas_data == label).astype(np.uint8), sanitize_region_name(name))
+        {"atlas_path": atlas_path, "label": int(label), "region_name": sanitize_region_name(name)}
         for label, name in zip(atlas_labels["Label"], atlas_labels["Name"])
-        if label != 0 and np.sum(atlas_data == label) > 0
+        if label != 0 and label in present_labels
     ]
 
     print(f"[INFO] Found {len(regions)} regions in the atlas for radiomics extraction.")
-    return process_radiomics(image_path, regions, output_csv)
\ No newline at end of file
+    return process_radiomics(image_path, regions, output_csv, executor=executor)
\ No newline at end of file
@@ -0,0 +1,511 @@
+import argparse
+import hashlib
+import importlib
+import os
+import pickle
+import sys
+import threading
+import time
+import traceback
+import uuid
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import Event, Process
+from pathlib import Path
+
+# Sub-directories of a file-queue broker, one per task state
+QUEUE_STATES = ("pending", "running", "done", "failed")
+
+# Workers refresh the mtime of the task they run every HEARTBEAT_INTERVAL seconds; a running
+# task whose mtime is older than LEASE_TIMEOUT seconds belongs to a dead worker and is re-queued
+# (counting as a failed attempt)
+HEARTBEAT_INTERVAL = 30.0
+LEASE_TIMEOUT = 300.0
+
+
+def _func_ref(func):
+    """
+    Returns an importable 'module:qualname' reference for `func`, so that workers started
+    from another interpreter (or another node) can resolve it.
+    """
+    module = func.__module__
+    if module == "__main__":
+        # Functions defined in a script run as __main__ (e.g. trex.py) are importable by file name
+        main_file = getattr(sys.modules["__main__"], "__file__", None)
+        if main_file is None:
+            raise ValueError(f"[ERROR] Cannot dispatch '{func.__qualname__}': it is not importable.")
+        module = Path(main_file).stem
+    return f"{module}:{func.__qualname__}"
+
+
+def _resolve_func(ref):
+    module_name, qualname = ref.split(":")
+    obj = importlib.import_module(module_name)
+    for attr in qualname.split("."):
+        obj = getattr(obj, attr)
+    return obj
+
+
+def _input_files(obj):
+    """
+    Yields `(path, mtime_ns, size)` for every existing file referenced by the task arguments.
+    """
+    if isinstance(obj, (list, tuple)):
+        for item in obj:
+            yield from _input_files(item)
+    elif isinstance(obj, dict):
+        for item in obj.values():
+            yield from _input_files(item)
+    elif isinstance(obj, (str, Path)) and os.path.isfile(obj):
+        stat = os.stat(obj)
+        yield str(Path(obj).resolve()), stat.st_mtime_ns, stat.st_size
+
+
+def _task_id(key, func_ref, args):
+    """
+    Identifies a task by its key, function, arguments and the state of its input files, so
+    that a stored result is only reused when none of them changed.
+    """
+    digest = hashlib.sha1()
+    digest.update(key.encode("utf-8"))
+    digest.update(func_ref.encode("utf-8"))
+    digest.update(pickle.dumps(args))
+    digest.update(repr(sorted(_input_files(args))).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _outputs_exist(result):
+    """
+    Checks that the files returned by a task (as `Path` objects) still exist.
+    """
+    if isinstance(result, (list, tuple)):
+        return all(_outputs_exist(item) for item in result)
+    if isinstance(result, dict):
+        return all(_outputs_exist(item) for item in result.values())
+    if isinstance(result, Path):
+        return result.exists()
+    return True
+
+
+def _check_unique_keys(tasks):
+    duplicates = sorted(key for key, count in Counter(key for key, _ in tasks).items() if count > 1)
+    if duplicates:
+        raise ValueError(f"[ERROR] Task keys must be unique. Duplicated keys: {duplicates}")
+
+
+def _call(func, args):
+    """
+    Runs `func(*args)` and returns `(result, error, elapsed_s)` instead of raising.
+    """
+    start_time = time.perf_counter()
+    try:
+        result, error = func(*args), None
+    except Exception as e:
+        result, error = None, f"{type(e).__name__}: {e}"
+    return result, error, round(time.perf_counter() - start_time, 3)
+
+
+def _write_atomic(path, payload):
+    # Write to a hidden temporary file first so readers never see a partial task/result
+    tmp_path = path.parent / f".{path.name}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(payload, f)
+    os.replace(tmp_path, path)
+
+
+def _read(path):
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def _claim_task_id(running_file):
+    # Claims are named '<task_id>.<claim token>.pkl' so that each worker only touches its own claim
+    return running_file.name.split(".")[0]
+
+
+def _init_queue(queue_dir):
+    queue_dir = Path(queue_dir)
+    dirs = {state: queue_dir / state for state in QUEUE_STATES}
+    for state_dir in dirs.values():
+        state_dir.mkdir(parents=True, exist_ok=True)
+    return dirs
+
+
+class TaskExecutor:
+    """
+    Interface for running independent pipeline tasks (subjects, regions, ...).
+
+    `run(func, tasks, reuse=True)` calls `func(*args)` for every `(key, args)` in `tasks` and
+    returns a list of `(key, result, error, elapsed_s)` tuples in the same order as `tasks`.
+    `error` is None on success, otherwise a message describing the last failure, and
+    `elapsed_s` is the duration of the last attempt. Task keys must be unique. With
+    `reuse=False`, backends that store results recompute them instead of reusing them.
+    """
+
+    def run(self, func, tasks, reuse=True):
+        raise NotImplementedError
+
+
+class LocalExecutor(TaskExecutor):
+    """
+    Default backend: runs tasks in a local process pool.
+
+    Args:
+        max_workers: Maximum number of worker processes.
+        retries: Number of times a failing task is resubmitted before being reported as failed.
+    """
+
+    def __init__(self, max_workers=8, retries=0):
+        if max_workers < 1:
+            raise ValueError("[ERROR] The local executor needs at least one worker.")
+        self.max_workers = max_workers
+        self.retries = retries
+
+    def run(self, func, tasks, reuse=True):
+        if not tasks:
+            return []
+        _check_unique_keys(tasks)
+
+        outcomes = {}
+        attempts = {key: 0 for key, _ in tasks}
+        pending = list(tasks)
+        while pending:
+            retry = []
+            suspects = []  # Tasks lost because a worker process died, possibly caused by another task
+            with ProcessPoolExecutor(max_workers=min(self.max_workers, len(pending))) as executor:
+                futures = []
+                for key, args in pending:
+                    try:
+                        futures.append((key, args, executor.submit(_call, func, args)))
+                    except BrokenProcessPool:
+                        suspects.append((key, args))
+                for key, args, future in futures:
+                    try:
+                        outcome = future.result()
+                    except BrokenProcessPool:
+                        suspects.append((key, args))
+                        continue
+                    self._record(key, args, outcome, attempts, outcomes, retry)
+
+            # Re-run lost tasks one by one in a fresh pool, so that only the task that kills its
+            # worker is charged an attempt
+            for key, args in suspects:
+                self._record(key, args, self._run_isolated(func, args), attempts, outcomes, retry)
+            pending = retry
+
+        return [(key, *outcomes[key]) for key, _ in tasks]
+
+    @staticmethod
+    def _run_isolated(func, args):
+        start_time = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            try:
+                return executor.submit(_call, func, args).result()
+            except BrokenProcessPool:
+                return None, "WorkerDied: the worker process died", round(time.perf_counter() - start_time, 3)
+
+    def _record(self, key, args, outcome, attempts, outcomes, retry):
+        result, error, elapsed = outcome
+        if error is None:
+            outcomes[key] = (result, None, elapsed)
+            return
+        attempts[key] += 1
+        if attempts[key] <= self.retries:
+            print(f"[WARNING] Task '{key}' failed ({error}). Retrying...")
+            retry.append((key, args))
+        else:
+            print(f"[ERROR] Task '{key}' failed with error: {error}")
+            outcomes[key] = (None, error, elapsed)
+
+
+class FileQueueExecutor(TaskExecutor):
+    """
+    Distributed backend using a shared directory as task broker.
+
+    Tasks are pickled into `<queue_dir>/pending`. Workers, started locally by this executor or
+    on other nodes with `python -m modules.task_executor --queue <queue_dir>`, claim a task by
+    atomically renaming it into `running`, keep it alive with a heartbeat, and store the
+    outcome in `done` or `failed`. A task whose worker stopped responding is re-queued, and
+    reported as failed once it used up its retries. A task is identified by its key, arguments and input files:
+    resubmitting an unchanged task whose output files still exist reuses its stored result,
+    while failed, changed or stale tasks are queued again.
+
+    Args:
+        queue_dir: Shared directory used as broker (must be visible to every worker).
+        workers: Number of local worker processes to start (0 relies on external workers only).
+        retries: Number of times a failing task is re-queued before being reported as failed.
+        poll_interval: Seconds between two scans of the queue.
+        lease_timeout: Seconds without heartbeat after which a running task is considered
+            abandoned by its worker and re-queued (None disables it).
+        heartbeat_interval: Seconds between two heartbeats of the local workers.
+    """
+
+    def __init__(self, queue_dir, workers=0, retries=2, poll_interval=1.0, lease_timeout=LEASE_TIMEOUT,
+                 heartbeat_interval=HEARTBEAT_INTERVAL):
+        self.queue_dir = Path(queue_dir).resolve()
+        self.workers = workers
+        self.retries = retries
+        self.poll_interval = poll_interval
+        self.lease_timeout = lease_timeout
+        self.heartbeat_interval = heartbeat_interval
+
+    def submit(self, func, tasks, reuse=True):
+        """
+        Enqueues the tasks that have no reusable result yet and returns their task ids.
+        """
+        _check_unique_keys(tasks)
+        dirs = _init_queue(self.queue_dir)
+        self._requeue_stale(dirs)
+        func_ref = _func_ref(func)
+        task_ids = []
+        queued = 0
+        for key, args in tasks:
+            task_id = _task_id(key, func_ref, args)
+            task_ids.append(task_id)
+            task_name = f"{task_id}.pkl"
+
+            done_file = dirs["done"] / task_name
+            if done_file.exists():
+                if reuse and _outputs_exist(_read(done_file).get("result")):
+                    continue
+                done_file.unlink(missing_ok=True)
+            if (dirs["pending"] / task_name).exists() or any(dirs["running"].glob(f"{task_id}.*")):
+                continue  # Already queued or being processed by a live worker
+
+            (dirs["failed"] / task_name).unlink(missing_ok=True)
+            _write_atomic(dirs["pending"] / task_name, {
+                "key": key,
+                "func": func_ref,
+                "args": args,
+                "attempts": 0,
+                "retries": self.retries,
+            })
+            queued += 1
+
+        print(f"[INFO] Queued {queued} of {len(tasks)} tasks in {self.queue_dir} "
+              f"({len(tasks) - queued} already done or in progress).")
+        return task_ids
+
+    def run(self, func, tasks, reuse=True):
+        if not tasks:
+            return []
+
+        task_ids = self.submit(func, tasks, reuse=reuse)
+        stop_event = Event()
+
+        def start_worker():
+            process = Process(target=run_worker, args=(self.queue_dir,),
+                              kwargs={"poll_interval": self.poll_interval,
+                                      "heartbeat_interval": self.heartbeat_interval, "stop_event": stop_event})
+            process.start()
+            return process
+
+        processes = [start_worker() for _ in range(self.workers)]
+        try:
+            records = self.collect(task_ids, processes, start_worker)
+        finally:
+            # Local workers keep polling (tasks may be re-queued) until every result is collected
+            stop_event.set()
+            for process in processes:
+                process.join()
+
+        return [
+            (key, records[task_id].get("result"), records[task_id].get("error"), records[task_id].get("elapsed_s"))
+            for (key, _), task_id in zip(tasks, task_ids)
+        ]
+
+    def collect(self, task_ids, processes=(), start_worker=None):
+        """
+        Waits until every task is done or failed and returns their records by task id.
+        Local worker `processes` that died (e.g. killed by a task) are replaced with `start_worker`.
+        """
+        dirs = _init_queue(self.queue_dir)
+        records = {}
+        while True:
+            for task_id in task_ids:
+                if task_id in records:
+                    continue
+                for state in ("done", "failed"):
+                    record_file = dirs[state] / f"{task_id}.pkl"
+                    if record_file.exists():
+                        records[task_id] = _read(record_file)
+                        break
+            if len(records) == len(task_ids):
+                return records
+
+            self._requeue_stale(dirs)
+
+            # Local workers only exit when stopped; their claims expire with the lease
+            if start_worker is not None:
+                for index, process in enumerate(processes):
+                    if not process.is_alive():
+                        print(f"[WARNING] Local worker {process.pid} died. Starting a new one.")
+                        processes[index] = start_worker()
+            time.sleep(self.poll_interval)
+
+    def _requeue_stale(self, dirs):
+        if self.lease_timeout is None:
+            return
+        now = time.time()
+        for running_file in dirs["running"].glob("*.pkl"):
+            try:
+                if now - running_file.stat().st_mtime <= self.lease_timeout:
+                    continue
+                # Take the claim over atomically, so that only one submitter handles it
+                owned_file = dirs["running"] / f".{running_file.name}.{uuid.uuid4().hex}.stale"
+                os.rename(running_file, owned_file)
+            except FileNotFoundError:
+                continue  # Finished or re-queued in the meantime
+
+            task = _read(owned_file)
+            task_name = f"{_claim_task_id(running_file)}.pkl"
+            task["attempts"] += 1
+            task["error"] = "WorkerDied: the worker stopped responding (lease expired)"
+            if task["attempts"] <= task["retries"]:
+                print(f"[WARNING] Task '{task['key']}' lost its worker. Retrying "
+                      f"({task['attempts']}/{task['retries']})...")
+                _write_atomic(dirs["pending"] / task_name, task)
+            else:
+                print(f"[ERROR] Task '{task['key']}' failed: its worker stopped responding.")
+                _write_atomic(dirs["failed"] / task_name, {
+                    "key": task["key"],
+                    "error": task["error"],
+                    "traceback": None,
+                    "attempts": task["attempts"],
+                    "elapsed_s": None,
+                })
+            owned_file.unlink()
+
+
+def _heartbeat(running_file, interval, stop_event):
+    while not stop_event.wait(interval):
+        try:
+            os.utime(running_file)
+        except FileNotFoundError:
+            return  # Lease expired and taken over by a submitter
+
+
+def _execute_task(running_file, dirs, heartbeat_interval):
+    try:
+        task = _read(running_file)
+    except FileNotFoundError:
+        return  # Claim lost to a submitter before the task started
+    task_name = f"{_claim_task_id(running_file)}.pkl"
+    heartbeat_stop = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat, args=(running_file, heartbeat_interval, heartbeat_stop),
+                                 daemon=True)
+    heartbeat.start()
+    try:
+        start_time = time.perf_counter()
+        try:
+            result = _resolve_func(task["func"])(*task["args"])
+        except Exception as e:
+            elapsed = round(time.perf_counter() - start_time, 3)
+            if not running_file.exists():
+                # The lease expired: the submitter already counted this attempt and re-queued the task
+                print(f"[WARNING] Task '{task['key']}' failed after losing its claim. Outcome dropped.")
+                return
+            task["attempts"] += 1
+            task["error"] = f"{type(e).__name__}: {e}"
+            if task["attempts"] <= task["retries"]:
+                print(f"[WARNING] Task '{task['key']}' failed ({e}). Retrying "
+                      f"({task['attempts']}/{task['retries']})...")
+                _write_atomic(dirs["pending"] / task_name, task)
+            else:
+                print(f"[ERROR] Task '{task['key']}' failed with error: {e}")
+                _write_atomic(dirs["failed"] / task_name, {
+                    "key": task["key"],
+                    "error": task["error"],
+                    "traceback": traceback.format_exc(),
+                    "attempts": task["attempts"],
+                    "elapsed_s": elapsed,
+                })
+        else:
+            # Results are idempotent, so they are kept even if the claim was lost meanwhile
+            elapsed = round(time.perf_counter() - start_time, 3)
+            _write_atomic(dirs["done"] / task_name, {"key": task["key"], "result": result, "elapsed_s": elapsed})
+    finally:
+        heartbeat_stop.set()
+        heartbeat.join()
+        running_file.unlink(missing_ok=True)  # Only this worker's own claim
+
+
+def run_worker(queue_dir, stop_when_empty=False, poll_interval=1.0, heartbeat_interval=HEARTBEAT_INTERVAL,
+               stop_event=None):
+    """
+    Processes tasks from a file-queue broker until stopped.
+
+    Args:
+        queue_dir: Shared directory used as broker.
+        stop_when_empty: Return as soon as no task is pending instead of waiting for new ones.
+        poll_interval: Seconds to wait between two scans of an empty queue.
+        heartbeat_interval: Seconds between two refreshes of the running task's lease.
+        stop_event: Optional event; the worker returns once it is set (after its current task).
+    """
+    dirs = _init_queue(queue_dir)
+    while stop_event is None or not stop_event.is_set():
+        claimed = False
+        for task_file in sorted(dirs["pending"].glob("*.pkl")):
+            running_file = dirs["running"] / f"{task_file.stem}.{uuid.uuid4().hex}.pkl"
+            try:
+                # The rename keeps the mtime, so refresh it first: the lease starts at claim time
+                os.utime(task_file)
+                os.rename(task_file, running_file)  # Atomic claim: only one worker wins
+            except FileNotFoundError:
+                continue
+            _execute_task(running_file, dirs, heartbeat_interval)
+            claimed = True
+            break
+
+        if not claimed:
+            if stop_when_empty:
+                return
+            if stop_event is not None:
+                stop_event.wait(poll_interval)
+            else:
+                time.sleep(poll_interval)
+
+
+def get_executor(backend="local", queue_dir=None, workers=None, retries=0, lease_timeout=LEASE_TIMEOUT):
+    """
+    Builds the executor selected on the command line.
+
+    Args:
+        backend: 'local' (process pool) or 'filequeue' (shared-directory broker).
+        queue_dir: Broker directory, required by the 'filequeue' backend.
+        workers: Number of local worker processes (default: 8 for 'local', 0 for 'filequeue').
+        retries: Number of retries for failing tasks.
+        lease_timeout: Seconds without heartbeat before a running 'filequeue' task is re-queued.
+
+    Returns:
+        TaskExecutor: The configured executor.
+    """
+    if backend == "local":
+        return LocalExecutor(max_workers=8 if workers is None else workers, retries=retries)
+    if backend == "filequeue":
+        if queue_dir is None:
+            raise ValueError("[ERROR] The 'filequeue' executor requires a queue directory.")
+        if lease_timeout is not None and lease_timeout <= HEARTBEAT_INTERVAL:
+            raise ValueError(f"[ERROR] The lease timeout must be longer than the worker heartbeat "
+                             f"({HEARTBEAT_INTERVAL} s).")
+        return FileQueueExecutor(queue_dir, workers=0 if workers is None else workers, retries=retries,
+                                 lease_timeout=lease_timeout)
+    raise ValueError(f"[ERROR] Unknown executor '{backend}': must be 'local' or 'filequeue'.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="T-REX file-queue worker")
+    parser.add_argument("--queue", type=str, required=True)
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    parser.add_argument("--heartbeat-interval", type=float, default=HEARTBEAT_INTERVAL)
+    parser.add_argument("--exit-when-empty", action="store_true")
+    args = parser.parse_args()
+
+    print(f"[INFO] Worker {os.getpid()} listening on {args.queue}")
+    run_worker(args.queue, stop_when_empty=args.exit_when_empty, poll_interval=args.poll_interval,
+               heartbeat_interval=args.heartbeat_interval)
+
+
+if __name__ == "__main__":
+    main()
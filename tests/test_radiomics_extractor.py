@@ -0,0 +1,142 @@
+import json
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pd = pytest.importorskip("pandas")
+pytest.importorskip("SimpleITK")
+pytest.importorskip("radiomics")
+
+from modules import radiomics_extractor
+from modules.radiomics_extractor import failures_path, process_radiomics, retry_failed_regions
+from modules.task_executor import LocalExecutor
+
+
+# Stand-ins for extract_features; importable by module name so that pool workers can run them
+def extract_or_fail(image_path, mask_path=None, region_label=None, region_name=None, atlas_path=None,
+                    atlas_label=None):
+    if region_name.startswith("bad"):
+        raise RuntimeError(f"cannot extract {region_name}")
+    value = float(atlas_label) if atlas_path else float(np.sum(region_label))
+    return {"region_name": region_name, "status": "ok", "original_firstorder_Mean": value}
+
+
+def extract_ok(image_path, mask_path=None, region_label=None, region_name=None, atlas_path=None,
+               atlas_label=None):
+    return {"region_name": region_name, "status": "ok", "original_firstorder_Mean": 42.0}
+
+
+def make_regions(names):
+    return [(np.full((2, 2, 2), index, dtype=np.uint8), name) for index, name in enumerate(names)]
+
+
+def test_process_radiomics_keeps_region_order_and_reports_failures(tmp_path, monkeypatch):
+    monkeypatch.setattr(radiomics_extractor, "extract_features", extract_or_fail)
+    names = ["frontal", "bad_temporal", "occipital", "bad_parietal", "insula"]
+    output_csv = tmp_path / "radiomics_features.csv"
+
+    atlas_regions = [
+        {"atlas_path": tmp_path / "atlas.nii.gz", "label": label, "region_name": name}
+        for label, name in enumerate(names, start=1)
+    ]
+
+    process_radiomics(tmp_path / "image.nii.gz", atlas_regions, output_csv, executor=LocalExecutor(max_workers=3))
+
+    results = pd.read_csv(output_csv)
+    assert list(results.columns[:4]) == radiomics_extractor.STATUS_COLUMNS
+    assert results["region_name"].tolist() == names
+    assert results["status"].tolist() == ["ok", "failed", "ok", "failed", "ok"]
+    assert results.loc[1, "error"] == "RuntimeError: cannot extract bad_temporal"
+    assert results["extraction_time_s"].notna().all()
+    assert results["original_firstorder_Mean"].tolist()[::2] == [1.0, 3.0, 5.0]
+
+    with open(failures_path(output_csv)) as f:
+        failures = json.load(f)
+    assert [(failure["row"], failure["region_name"], failure["label"]) for failure in failures] == [
+        (1, "bad_temporal", 2), (3, "bad_parietal", 4)
+    ]
+    assert failures[0]["atlas_path"] == str(tmp_path / "atlas.nii.gz")
+
+
+def test_process_radiomics_keeps_masks_sharing_a_name(tmp_path, monkeypatch):
+    monkeypatch.setattr(radiomics_extractor, "extract_features", extract_or_fail)
+    output_csv = tmp_path / "radiomics_features.csv"
+
+    process_radiomics(tmp_path / "image.nii.gz", make_regions(["lesion", "lesion"]), output_csv,
+                      executor=LocalExecutor(max_workers=2))
+
+    assert pd.read_csv(output_csv)["original_firstorder_Mean"].tolist() == [0.0, 8.0]
+    assert not failures_path(output_csv).exists()
+
+
+def write_failed_results(tmp_path):
+    results_csv = tmp_path / "image_results.csv"
+    pd.DataFrame({
+        "Image": ["image"] * 3,
+        "Source": ["input_roi"] * 3,
+        "region_name": ["lesion", "lesion", "edema"],
+        "status": ["ok", "failed", "failed"],
+        "error": [np.nan, "RuntimeError: boom", "RuntimeError: boom"],
+        "extraction_time_s": [1.5, 0.1, 0.2],
+        "original_firstorder_Mean": [7.0, np.nan, np.nan],
+    }).to_csv(results_csv, index=False)
+
+    failures_json = tmp_path / "image_failures.json"
+    with open(failures_json, "w") as f:
+        json.dump([
+            {"key": "k1", "row": 1, "image": "image.nii.gz", "region_name": "lesion",
+             "mask_path": "b/lesion.nii.gz", "Source": "input_roi", "error": "RuntimeError: boom"},
+            {"key": "k2", "row": 2, "image": "image.nii.gz", "region_name": "edema",
+             "mask_path": "edema.nii.gz", "Source": "input_roi", "error": "RuntimeError: boom"},
+        ], f)
+    return results_csv, failures_json
+
+
+def test_retry_failed_regions_updates_only_failed_rows(tmp_path, monkeypatch):
+    monkeypatch.setattr(radiomics_extractor, "extract_features", extract_ok)
+    results_csv, failures_json = write_failed_results(tmp_path)
+
+    assert retry_failed_regions(failures_json, results_csv, executor=LocalExecutor(max_workers=2)) == []
+
+    results = pd.read_csv(results_csv)
+    assert results["status"].tolist() == ["ok", "ok", "ok"]
+    assert results["error"].isna().all()
+    assert results["original_firstorder_Mean"].tolist() == [7.0, 42.0, 42.0]
+    assert results.loc[0, "extraction_time_s"] == 1.5
+    assert not failures_json.exists()
+
+
+def test_retry_failed_regions_keeps_report_of_regions_failing_again(tmp_path, monkeypatch):
+    monkeypatch.setattr(radiomics_extractor, "extract_features", extract_or_fail)
+    results_csv, failures_json = write_failed_results(tmp_path)
+    with open(failures_json) as f:
+        failures = json.load(f)
+    failures[1]["region_name"] = "bad_edema"
+    with open(failures_json, "w") as f:
+        json.dump(failures[1:], f)
+    pd.read_csv(results_csv).replace("edema", "bad_edema").to_csv(results_csv, index=False)
+
+    remaining = retry_failed_regions(failures_json, results_csv, executor=LocalExecutor(max_workers=1))
+
+    assert [failure["row"] for failure in remaining] == [2]
+    assert remaining[0]["error"] == "RuntimeError: cannot extract bad_edema"
+    results = pd.read_csv(results_csv)
+    assert results["status"].tolist() == ["ok", "failed", "failed"]
+    assert results.loc[2, "error"] == "RuntimeError: cannot extract bad_edema"
+    assert failures_json.exists()
+
+
+def test_atlas_is_loaded_once_per_version(tmp_path, monkeypatch):
+    nib = pytest.importorskip("nibabel")
+    atlas_path = tmp_path / "atlas.nii.gz"
+    nib.save(nib.Nifti1Image(np.arange(8, dtype=np.int16).reshape(2, 2, 2), np.eye(4)), str(atlas_path))
+    loads = []
+    load = nib.load
+    monkeypatch.setattr(nib, "load", lambda path: loads.append(path) or load(path))
+    radiomics_extractor._load_atlas.cache_clear()
+
+    for _ in range(3):
+        radiomics_extractor._load_atlas(str(atlas_path), 1)
+    radiomics_extractor._load_atlas(str(atlas_path), 2)  # The file changed
+
+    assert len(loads) == 2
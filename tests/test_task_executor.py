@@ -0,0 +1,283 @@
+import os
+import time
+import uuid
+from multiprocessing import Event, Process
+from pathlib import Path
+
+import pytest
+
+from modules.task_executor import FileQueueExecutor, LocalExecutor, _execute_task, _init_queue, get_executor, run_worker
+
+
+# Task functions must be importable by module name so that workers can resolve them
+def square(value, log_dir=None):
+    if log_dir is not None:
+        (Path(log_dir) / f"{value}-{uuid.uuid4().hex}").touch()
+    return value * value
+
+
+def fail(log_dir):
+    (Path(log_dir) / uuid.uuid4().hex).touch()
+    raise ValueError("boom")
+
+
+def sleep_square(value, seconds, log_dir):
+    (Path(log_dir) / f"{value}-{uuid.uuid4().hex}").touch()
+    time.sleep(seconds)
+    return value * value
+
+
+def read_file(path, log_dir):
+    (Path(log_dir) / uuid.uuid4().hex).touch()
+    return Path(path).read_text()
+
+
+def write_file(path, log_dir):
+    (Path(log_dir) / uuid.uuid4().hex).touch()
+    Path(path).write_text("result")
+    return Path(path)
+
+
+def crash():
+    os._exit(1)
+
+
+def crash_on_three(value):
+    if value == 3:
+        os._exit(1)
+    time.sleep(0.2)  # Still running when the other worker dies
+    return value * value
+
+
+def count_calls(log_dir):
+    return len(list(Path(log_dir).iterdir()))
+
+
+def make_executor(queue_dir, **kwargs):
+    kwargs.setdefault("poll_interval", 0.05)
+    return FileQueueExecutor(queue_dir, **kwargs)
+
+
+@pytest.fixture
+def log_dir(tmp_path):
+    log_dir = tmp_path / "calls"
+    log_dir.mkdir()
+    return log_dir
+
+
+def test_local_executor_returns_results_in_task_order():
+    outcomes = LocalExecutor(max_workers=4).run(square, [(f"k{i}", (i,)) for i in range(10)])
+    assert [(key, result, error) for key, result, error, _ in outcomes] == [
+        (f"k{i}", i * i, None) for i in range(10)
+    ]
+
+
+def test_local_executor_retries_then_reports_failure(log_dir):
+    [(key, result, error, elapsed)] = LocalExecutor(max_workers=1, retries=2).run(fail, [("k", (log_dir,))])
+    assert (key, result, error) == ("k", None, "ValueError: boom")
+    assert elapsed is not None
+    assert count_calls(log_dir) == 3
+
+
+def test_local_executor_rejects_duplicate_keys():
+    with pytest.raises(ValueError):
+        LocalExecutor().run(square, [("k", (0,)), ("k", (1,))])
+
+
+@pytest.mark.parametrize("retries", [0, 1])
+def test_local_executor_survives_crashed_worker(retries):
+    outcomes = LocalExecutor(max_workers=4, retries=retries).run(crash_on_three, [(f"k{i}", (i,)) for i in range(6)])
+    assert [(key, result) for key, result, _, _ in outcomes] == [
+        ("k0", 0), ("k1", 1), ("k2", 4), ("k3", None), ("k4", 16), ("k5", 25)
+    ]
+    assert [error for _, _, error, _ in outcomes] == [None] * 3 + ["WorkerDied: the worker process died"] + [None] * 2
+
+
+def test_get_executor_rejects_zero_local_workers():
+    with pytest.raises(ValueError):
+        get_executor("local", workers=0)
+
+
+def test_file_queue_returns_results_in_task_order(tmp_path):
+    outcomes = make_executor(tmp_path / "queue", workers=2).run(square, [(f"k{i}", (i,)) for i in range(10)])
+    assert [(key, result, error) for key, result, error, _ in outcomes] == [
+        (f"k{i}", i * i, None) for i in range(10)
+    ]
+
+
+def test_file_queue_retries_then_reports_failure(tmp_path, log_dir):
+    executor = make_executor(tmp_path / "queue", workers=1, retries=1)
+    [(_, result, error, elapsed)] = executor.run(fail, [("k", (log_dir,))])
+    assert (result, error) == (None, "ValueError: boom")
+    assert elapsed is not None
+    assert count_calls(log_dir) == 2
+
+
+def test_file_queue_rejects_duplicate_keys(tmp_path):
+    with pytest.raises(ValueError):
+        make_executor(tmp_path / "queue", workers=1).run(square, [("k", (0,)), ("k", (1,))])
+
+
+def test_file_queue_reuses_done_results(tmp_path, log_dir):
+    executor = make_executor(tmp_path / "queue", workers=1)
+    tasks = [(f"k{i}", (i, log_dir)) for i in range(3)]
+    assert [result for _, result, _, _ in executor.run(square, tasks)] == [0, 1, 4]
+    assert [result for _, result, _, _ in executor.run(square, tasks)] == [0, 1, 4]
+    assert count_calls(log_dir) == 3
+
+    executor.run(square, tasks, reuse=False)
+    assert count_calls(log_dir) == 6
+
+
+def test_file_queue_requeues_failed_tasks(tmp_path, log_dir):
+    executor = make_executor(tmp_path / "queue", workers=1, retries=0)
+    executor.run(fail, [("k", (log_dir,))])
+    executor.run(fail, [("k", (log_dir,))])
+    assert count_calls(log_dir) == 2
+
+
+def test_file_queue_recomputes_when_args_change(tmp_path):
+    executor = make_executor(tmp_path / "queue", workers=1)
+    assert executor.run(square, [("k", (0,))])[0][1] == 0
+    assert executor.run(square, [("k", (0.5,))])[0][1] == 0.25
+
+
+def test_file_queue_recomputes_when_input_file_changes(tmp_path, log_dir):
+    executor = make_executor(tmp_path / "queue", workers=1)
+    input_file = tmp_path / "input.txt"
+    input_file.write_text("old")
+    assert executor.run(read_file, [("k", (str(input_file), log_dir))])[0][1] == "old"
+
+    input_file.write_text("new content")
+    assert executor.run(read_file, [("k", (str(input_file), log_dir))])[0][1] == "new content"
+    assert count_calls(log_dir) == 2
+
+
+def test_file_queue_recomputes_when_output_is_missing(tmp_path, log_dir):
+    executor = make_executor(tmp_path / "queue", workers=1)
+    output_file = tmp_path / "output" / "result.txt"
+    output_file.parent.mkdir()
+    tasks = [("k", (output_file, log_dir))]
+    executor.run(write_file, tasks)
+    output_file.unlink()
+
+    assert executor.run(write_file, tasks)[0][1] == output_file
+    assert output_file.exists()
+    assert count_calls(log_dir) == 2
+
+
+def test_file_queue_claims_each_task_once(tmp_path, log_dir):
+    queue_dir = tmp_path / "queue"
+    executor = make_executor(queue_dir)
+    executor.submit(square, [(f"k{i}", (i, log_dir)) for i in range(40)])
+
+    workers = [
+        Process(target=run_worker, args=(queue_dir,), kwargs={"stop_when_empty": True})
+        for _ in range(2)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    calls = sorted(int(path.name.split("-")[0]) for path in log_dir.iterdir())
+    assert calls == list(range(40))
+    assert len(list((queue_dir / "done").glob("*.pkl"))) == 40
+
+
+def test_stale_running_task_is_requeued_on_submit(tmp_path):
+    queue_dir = tmp_path / "queue"
+    executor = make_executor(queue_dir, workers=1, lease_timeout=1.0)
+    executor.submit(square, [("k", (3,))])
+
+    # Simulate a worker killed right after claiming the task
+    [task_file] = (queue_dir / "pending").glob("*.pkl")
+    running_file = queue_dir / "running" / task_file.name
+    os.rename(task_file, running_file)
+    os.utime(running_file, (time.time() - 60, time.time() - 60))
+
+    [(_, result, error, _)] = executor.run(square, [("k", (3,))])
+    assert (result, error) == (9, None)
+    assert not any((queue_dir / "running").iterdir())
+
+
+def test_heartbeat_keeps_long_task_leased(tmp_path, log_dir):
+    executor = make_executor(tmp_path / "queue", workers=2, lease_timeout=0.5, heartbeat_interval=0.1)
+    [(_, result, error, _)] = executor.run(sleep_square, [("k", (3, 1.5, log_dir))])
+    assert (result, error) == (9, None)
+    assert count_calls(log_dir) == 1
+
+
+def test_stale_task_without_retries_left_is_reported_as_failed(tmp_path):
+    queue_dir = tmp_path / "queue"
+    executor = make_executor(queue_dir, retries=0, lease_timeout=1.0)
+    [task_id] = executor.submit(square, [("k", (3,))])
+
+    # Simulate an external worker killed while running the task
+    [task_file] = (queue_dir / "pending").glob("*.pkl")
+    running_file = queue_dir / "running" / f"{task_file.stem}.claim.pkl"
+    os.rename(task_file, running_file)
+    os.utime(running_file, (time.time() - 60, time.time() - 60))
+
+    # No local worker: the lease expiry alone must end the collection
+    record = executor.collect([task_id])[task_id]
+    assert record["error"].startswith("WorkerDied")
+    assert record["attempts"] == 1
+
+
+def test_crashed_local_workers_are_reported(tmp_path):
+    executor = make_executor(tmp_path / "queue", workers=1, retries=1, lease_timeout=0.5, heartbeat_interval=0.1)
+    [(_, result, error, _)] = executor.run(crash, [("k", ())])
+    assert result is None
+    assert error.startswith("WorkerDied")
+
+
+def test_worker_survives_claim_lost_before_start(tmp_path):
+    queue_dir = tmp_path / "queue"
+    dirs = _init_queue(queue_dir)
+    executor = make_executor(queue_dir, lease_timeout=1.0)
+    executor.submit(square, [("k", (3,))])
+
+    # A task that waited in pending longer than the lease, claimed without a fresh mtime
+    [task_file] = (queue_dir / "pending").glob("*.pkl")
+    os.utime(task_file, (time.time() - 60, time.time() - 60))
+    running_file = queue_dir / "running" / f"{task_file.stem}.claim.pkl"
+    os.rename(task_file, running_file)
+    executor._requeue_stale(dirs)
+
+    _execute_task(running_file, dirs, heartbeat_interval=0.1)
+    assert [path.name for path in (queue_dir / "pending").iterdir()] == [task_file.name]
+
+
+def test_claim_starts_a_fresh_lease(tmp_path):
+    queue_dir = tmp_path / "queue"
+    executor = make_executor(queue_dir, workers=1, lease_timeout=1.0, heartbeat_interval=0.1)
+    tasks = [("k", (3,))]
+    executor.submit(square, tasks)
+    [task_file] = (queue_dir / "pending").glob("*.pkl")
+    os.utime(task_file, (time.time() - 60, time.time() - 60))
+
+    [(_, result, error, _)] = executor.run(square, tasks)
+    assert (result, error) == (9, None)
+
+
+def test_local_workers_wait_for_external_worker(tmp_path, log_dir):
+    queue_dir = tmp_path / "queue"
+    tasks = [("k", (3, 1.0, log_dir))]
+    make_executor(queue_dir).submit(sleep_square, tasks)
+
+    stop_event = Event()
+    external = Process(target=run_worker, args=(queue_dir,), kwargs={"poll_interval": 0.05, "stop_event": stop_event})
+    external.start()
+    try:
+        while not any((queue_dir / "running").iterdir()):
+            time.sleep(0.01)
+
+        # The local worker finds nothing pending and must not make the run fail
+        [(_, result, error, _)] = make_executor(queue_dir, workers=1).run(sleep_square, tasks)
+    finally:
+        stop_event.set()
+        external.join()
+
+    assert (result, error) == (9, None)
+    assert count_calls(log_dir) == 1
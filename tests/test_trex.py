@@ -0,0 +1,57 @@
+import json
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+for module in ("numpy", "nibabel", "SimpleITK", "radiomics", "ants", "nipype"):
+    pytest.importorskip(module)
+
+from trex import merge_failure_reports, merge_radiomics_outputs
+
+
+def write_radiomics_csv(path, region_names, status=None):
+    status = status or ["ok"] * len(region_names)
+    pd.DataFrame({
+        "region_name": region_names,
+        "status": status,
+        "error": ["RuntimeError: boom" if s == "failed" else None for s in status],
+        "extraction_time_s": [0.5] * len(region_names),
+        "original_firstorder_Mean": [1.0] * len(region_names),
+    }).to_csv(path, index=False)
+
+
+def write_sources(output_dir):
+    # Created in reverse order: the merge must not depend on directory listing order
+    write_radiomics_csv(output_dir / "lesion.csv", ["lesion"])
+    write_radiomics_csv(output_dir / "radiomics_features.csv", ["frontal", "temporal"], ["ok", "failed"])
+    write_radiomics_csv(output_dir / "brain_radiomics.csv", ["brain_mask"])
+    with open(output_dir / "radiomics_features.failures.json", "w") as f:
+        json.dump([{"key": "k", "row": 1, "region_name": "temporal", "error": "RuntimeError: boom"}], f)
+    with open(output_dir / "extracted_metadata.json", "w") as f:
+        json.dump({"Manufacturer": "Siemens"}, f)
+
+
+def test_merge_radiomics_outputs_orders_sources(tmp_path):
+    write_sources(tmp_path)
+    final_csv = tmp_path / "image_results.csv"
+
+    merge_radiomics_outputs(tmp_path, final_csv, tmp_path / "extracted_metadata.json")
+    # A second merge must ignore the previous combined CSV
+    merge_radiomics_outputs(tmp_path, final_csv, tmp_path / "extracted_metadata.json")
+
+    results = pd.read_csv(final_csv)
+    assert results["Source"].tolist() == ["brain_mask", "atlas", "atlas", "input_roi"]
+    assert results["region_name"].tolist() == ["brain_mask", "frontal", "temporal", "lesion"]
+    assert list(results.columns[:6]) == ["Image", "Source", "region_name", "status", "error", "extraction_time_s"]
+
+
+def test_merge_failure_reports_points_to_combined_rows(tmp_path):
+    write_sources(tmp_path)
+    final_csv = tmp_path / "image_results.csv"
+    merge_radiomics_outputs(tmp_path, final_csv, tmp_path / "extracted_metadata.json")
+
+    failures = merge_failure_reports(tmp_path, final_csv, tmp_path / "image_failures.json")
+
+    assert [(failure["row"], failure["Source"]) for failure in failures] == [(2, "atlas")]
+    assert pd.read_csv(final_csv).loc[2, "region_name"] == "temporal"
+    assert not (tmp_path / "radiomics_features.failures.json").exists()
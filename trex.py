@@ -1,4 +1,5 @@
 import argparse
+import json
 from pathlib import Path
 import shutil
 
@@ -7,7 +8,18 @@ from modules.dicom_nii_converter import convert_dicom_to_nifti
 from modules.metadata_extractor import extract_metadata, save_metadata
 from modules.brain_extractor import perform_brain_extraction
 from modules.atlas_register import register_atlas
-from modules.radiomics_extractor import process_radiomics, atlas_based_radiomics
+from modules.radiomics_extractor import (
+    process_radiomics, atlas_based_radiomics, retry_failed_regions, failures_path, STATUS_COLUMNS
+)
+from modules.task_executor import get_executor, LocalExecutor, LEASE_TIMEOUT
+
+ATLAS_LABELS = Path(__file__).resolve().parent / "atlas" / "atlas_anat_labels.csv"
+
+# Mappings from intermediate CSV names to the `Source` column, in output order
+SOURCE_MAP = {
+    "brain_radiomics": "brain_mask",
+    "radiomics_features": "atlas",
+}
 
 def parse_bool_option(option):
     if option.lower() == "no":
@@ -17,12 +29,23 @@ def parse_bool_option(option):
     else:
         raise ValueError(f"[ERROR] Invalid option '{option}': must be 'yes' or 'no'.")
 
+def get_image_name(input_path):
+    return Path(input_path).with_suffix("").with_suffix("").stem
+
 def validate_and_adjust_args(args):
-    input_path = Path(args.input)
-    if not input_path.exists():
-        raise FileNotFoundError(f"[ERROR] The input file '{args.input}' does not exist.")
-    if [suffix.lower() for suffix in input_path.suffixes] not in [['.nii'], ['.nii', '.gz'], ['.dcm']]:
-        raise ValueError("[ERROR] Input must be a NIfTI (.nii or .nii.gz) or DICOM (.dcm) file.")
+    for input_file in args.input:
+        input_path = Path(input_file)
+        if not input_path.exists():
+            raise FileNotFoundError(f"[ERROR] The input file '{input_file}' does not exist.")
+        if [suffix.lower() for suffix in input_path.suffixes] not in [['.nii'], ['.nii', '.gz'], ['.dcm']]:
+            raise ValueError("[ERROR] Input must be a NIfTI (.nii or .nii.gz) or DICOM (.dcm) file.")
+
+    image_names = [get_image_name(input_file) for input_file in args.input]
+    if len(set(image_names)) != len(image_names):
+        raise ValueError("[ERROR] Input images must have distinct file names.")
+
+    if args.executor == "filequeue" and args.queue_dir is None:
+        raise ValueError("[ERROR] --queue-dir is required when --executor is 'filequeue'.")
 
     if not args.bet and args.register:
         print("[WARNING] --register has been automatically disabled because --bet is set to no.")
@@ -42,6 +65,17 @@ def check_dependency(cmd, name):
     if not shutil.which(cmd):
         raise EnvironmentError(f"[ERROR] Dependency '{name}' is missing. Install it first.")
 
+def radiomics_csvs(output_dir, output_csv):
+    """
+    Lists the intermediate radiomics CSV files of `output_dir` (all but `output_csv`), with sources
+    in a fixed order so that rows are deterministic across runs.
+    """
+    return sorted(
+        (csv_file for csv_file in Path(output_dir).glob("*.csv") if csv_file != Path(output_csv)),
+        key=lambda csv_file: (list(SOURCE_MAP).index(csv_file.stem) if csv_file.stem in SOURCE_MAP
+                              else len(SOURCE_MAP), csv_file.name)
+    )
+
 def merge_radiomics_outputs(output_dir, output_csv, metadata_json):
     """
     Combines multiple radiomics CSV files into one final CSV, assigns explicit `Source` labels,
@@ -57,13 +91,7 @@ def merge_radiomics_outputs(output_dir, output_csv, metadata_json):
     """
     import pandas as pd
 
-    # Define mappings for source column
-    SOURCE_MAP = {
-        "brain_radiomics": "brain_mask",
-        "radiomics_features": "atlas",
-    }
-
-    csv_files = list(output_dir.glob("*.csv"))
+    csv_files = radiomics_csvs(output_dir, output_csv)
     combined_data = pd.concat(
         pd.read_csv(csv_file).assign(Source=SOURCE_MAP.get(csv_file.stem, "input_roi"))  # Default is `input_roi`
         for csv_file in csv_files
@@ -85,7 +113,7 @@ def merge_radiomics_outputs(output_dir, output_csv, metadata_json):
     combined_data = pd.concat([combined_data, metadata], axis=1)
 
     # Reorganize columns
-    cols = ["Image", "Source", "region_name"]  # Mandatory columns
+    cols = ["Image", "Source"] + STATUS_COLUMNS  # Mandatory columns
     metadata_cols = [col for col in metadata.columns if col not in cols]  # Metadata columns
     radiomics_cols = [col for col in combined_data.columns if col.startswith("original")]
     final_col_order = cols + metadata_cols + radiomics_cols
@@ -97,61 +125,118 @@ def merge_radiomics_outputs(output_dir, output_csv, metadata_json):
     combined_data.to_csv(output_csv, index=False)
     print(f"[INFO] Combined radiomics features (with metadata) saved to {output_csv}")
 
-def main():
-    check_dependency("flirt", "FSL FLIRT")
-    check_dependency("antsRegistration", "ANTs tools")
+def merge_failure_reports(output_dir, output_csv, failures_json):
+    """
+    Combines the failure reports of the intermediate radiomics CSVs into one JSON report,
+    adding the `Source` of each failed region and its `row` in the combined CSV.
 
-    parser = argparse.ArgumentParser(description="T-REX: The Radiomics Extractor")
-    parser.add_argument("--input", type=str, required=True)
-    parser.add_argument("--output", type=str, required=True)
-    parser.add_argument("--roi", nargs="*", default="no")
-    parser.add_argument("--metadata", type=str, default="yes")
-    parser.add_argument("--bet", type=str, default="yes")
-    parser.add_argument("--register", type=str, default="yes")
-    parser.add_argument("--radiomics", type=str, default="yes")
+    Args:
+        output_dir: Directory containing intermediate CSV files and their failure reports.
+        output_csv: Path to the combined CSV written by `merge_radiomics_outputs`.
+        failures_json: Path to the combined failure report (removed if no region failed).
 
-    args = parser.parse_args()
+    Returns:
+        list: The failed regions.
+    """
+    import pandas as pd
 
-    args.metadata = parse_bool_option(args.metadata)
-    args.bet = parse_bool_option(args.bet)
-    args.register = parse_bool_option(args.register)
-    args.radiomics = parse_bool_option(args.radiomics)
+    failures = []
+    offset = 0  # Row of the first region of each source in the combined CSV
+    for csv_file in radiomics_csvs(output_dir, output_csv):
+        report_path = failures_path(csv_file)
+        if report_path.exists():
+            with open(report_path, "r") as f:
+                source = SOURCE_MAP.get(csv_file.stem, "input_roi")
+                failures.extend(
+                    {**failure, "Source": source, "row": offset + failure["row"]} for failure in json.load(f)
+                )
+            report_path.unlink()
+        offset += len(pd.read_csv(csv_file))
+
+    if failures:
+        with open(failures_json, "w") as f:
+            json.dump(failures, f, indent=4)
+        print(f"[WARNING] {len(failures)} regions failed. Failure report saved to {failures_json}")
+    else:
+        Path(failures_json).unlink(missing_ok=True)
+    return failures
 
-    validate_and_adjust_args(args)
+def build_cohort_table(result_csvs, cohort_csv):
+    """
+    Concatenates the per-subject result CSVs into one cohort table.
 
-    output_dir = Path(args.output)
+    Args:
+        result_csvs: Paths to the per-subject `<image>_results.csv` files, in subject order.
+        cohort_csv: Path to the cohort output CSV.
+
+    Returns:
+        None: Saves the cohort table to `cohort_csv`.
+    """
+    import pandas as pd
+
+    cohort = pd.concat((pd.read_csv(result_csv) for result_csv in result_csvs), ignore_index=True)
+    cohort.to_csv(cohort_csv, index=False)
+    print(f"[INFO] Cohort table ({len(result_csvs)} subjects) saved to {cohort_csv}")
+
+def run_pipeline(input_file, output_dir, roi="no", metadata=True, bet=True, register=True, radiomics=True,
+                 executor=None, retry_failed=False):
+    """
+    Runs all enabled pipeline steps for a single image.
+
+    Args:
+        input_file: Path to the input DICOM or NIfTI image.
+        output_dir: Directory where the subject results are saved.
+        roi: List of NIfTI ROI mask paths, or 'no'.
+        metadata, bet, register, radiomics: Enabled pipeline steps.
+        executor: Executor for the region-level radiomics tasks (local process pool if None).
+        retry_failed: If results already exist, only re-run the regions listed in their failure report.
+
+    Returns:
+        Path | None: Path to the final results CSV, or None if radiomics is disabled.
+    """
+    output_dir = Path(output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
 
+    image_name = get_image_name(input_file)
+    final_csv = output_dir / f"{image_name}_results.csv"
+    failures_json = output_dir / f"{image_name}_failures.json"
+    if retry_failed and final_csv.exists():
+        if failures_json.exists():
+            retry_failed_regions(failures_json, final_csv, executor=executor)
+        else:
+            print(f"[INFO] No failed regions to retry for {input_file}.")
+        return final_csv
+
     nifti_image = None
     json_path = None
     
-    if args.input.endswith('.dcm'):
-        nifti_image, json_path = convert_dicom_to_nifti(args.input, output_dir)
+    if str(input_file).endswith('.dcm'):
+        nifti_image, json_path = convert_dicom_to_nifti(input_file, output_dir)
     else:
-        nifti_image = Path(args.input)
+        nifti_image = Path(input_file)
         json_path = nifti_image.with_suffix("").with_suffix(".json")
         # print(f"[DEBUG] Generated JSON path: {json_path}")  # Debug
     
     # Check if JSON metadata file exists
     # print(f"[DEBUG] Checking for JSON metadata file at path: {json_path}")
     if not json_path.exists():
-        print(f"[WARNING] JSON metadata file not found for {args.input}. Expected path: {json_path}")
+        print(f"[WARNING] JSON metadata file not found for {input_file}. Expected path: {json_path}")
     else:
         print("[INFO] JSON metadata file found.")
 
-    if args.metadata:
+    if metadata:
         metadata = extract_metadata(nifti_image, json_path)
         save_metadata(metadata, output_dir)
 
     brain_mask = None
-    if args.bet:
+    if bet:
         brain_mask = perform_brain_extraction(nifti_image, output_dir)
 
     registered_template, registered_atlas = None, None
-    if args.register:
+    if register:
         registered_template, registered_atlas = register_atlas(nifti_image, brain_mask, output_dir)
 
-    if args.radiomics:
+    if radiomics:
         output_csv = output_dir / "radiomics_features.csv"
 
         # 1. Process brain mask separately
@@ -159,38 +244,134 @@ def main():
             process_radiomics(
                 nifti_image, 
                 [brain_mask],  # Single-item list for this mask
-                output_dir / "brain_radiomics.csv"  # Save these features in a separate file
+                output_dir / "brain_radiomics.csv",  # Save these features in a separate file
+                executor=executor
             )
 
         # 2. Process atlas regions if registration is active
         rois = []
-        if args.roi != "no":
-            rois.extend(args.roi)
+        if roi != "no":
+            rois.extend(roi)
 
-        if args.register and registered_atlas:
+        if register and registered_atlas:
             atlas_based_radiomics(
                 nifti_image,
                 registered_atlas,
-                labels_path="atlas/atlas_anat_labels.csv",
-                output_csv=output_csv
+                labels_path=ATLAS_LABELS,
+                output_csv=output_csv,
+                executor=executor
             )
         elif rois:
-            process_radiomics(nifti_image, rois, output_csv)
+            process_radiomics(nifti_image, rois, output_csv, executor=executor)
         else:
             raise ValueError("[ERROR] No suitable ROIs found for radiomics extraction.")
 
         # 3. Combine results and include metadata
-        image_name = Path(args.input).with_suffix("").with_suffix("").stem
         metadata_json = output_dir / "extracted_metadata.json"
-        final_csv = output_dir / f"{image_name}_results.csv"
         merge_radiomics_outputs(output_dir, final_csv, metadata_json)
+        merge_failure_reports(output_dir, final_csv, failures_json)
 
         # Optional: Clean up temporary files
         for tmp_file in output_dir.glob("*.csv"):
             if tmp_file.stem != f"{image_name}_results":
                 tmp_file.unlink()  # Delete intermediate files
+    else:
+        final_csv = None
+
+    return final_csv
 
-    print(f"[INFO] Pipeline completed successfully. Results saved to {final_csv}")
+def main():
+    check_dependency("flirt", "FSL FLIRT")
+    check_dependency("antsRegistration", "ANTs tools")
+
+    parser = argparse.ArgumentParser(description="T-REX: The Radiomics Extractor")
+    parser.add_argument("--input", nargs="+", required=True)
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--roi", nargs="*", default="no")
+    parser.add_argument("--metadata", type=str, default="yes")
+    parser.add_argument("--bet", type=str, default="yes")
+    parser.add_argument("--register", type=str, default="yes")
+    parser.add_argument("--radiomics", type=str, default="yes")
+    parser.add_argument("--executor", choices=["local", "filequeue"], default="local")
+    parser.add_argument("--queue-dir", type=str, default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--retries", type=int, default=0)
+    parser.add_argument("--lease-timeout", type=float, default=LEASE_TIMEOUT)
+    parser.add_argument("--retry-failed", type=str, default="no")
+
+    args = parser.parse_args()
+
+    args.metadata = parse_bool_option(args.metadata)
+    args.bet = parse_bool_option(args.bet)
+    args.register = parse_bool_option(args.register)
+    args.radiomics = parse_bool_option(args.radiomics)
+    args.retry_failed = parse_bool_option(args.retry_failed)
+
+    validate_and_adjust_args(args)
+
+    output_dir = Path(args.output).resolve()
+    executor = get_executor(args.executor, args.queue_dir, args.workers, args.retries, args.lease_timeout)
+    options = {
+        "roi": [str(Path(roi).resolve()) for roi in args.roi] if args.roi != "no" else "no",
+        "metadata": args.metadata,
+        "bet": args.bet,
+        "register": args.register,
+        "radiomics": args.radiomics,
+        "retry_failed": args.retry_failed,
+    }
+
+    # Single image: the executor distributes the region-level radiomics tasks
+    if len(args.input) == 1:
+        final_csv = run_pipeline(args.input[0], output_dir, executor=executor, **options)
+        print(f"[INFO] Pipeline completed successfully. Results saved to {final_csv}")
+        return
+
+    # Cohort: the executor distributes one task per subject, each saved in its own sub-directory.
+    # Subjects already run in parallel, so each one extracts its regions in a single process.
+    region_executor = LocalExecutor(max_workers=1, retries=args.retries)
+    tasks = []
+    for input_file in args.input:
+        input_path = Path(input_file).resolve()
+        subject_dir = output_dir / get_image_name(input_path)
+        key = f"subject:{input_path}:{subject_dir}:{sorted(options.items())}"
+        tasks.append((key, (str(input_path), subject_dir, options["roi"], options["metadata"], options["bet"],
+                            options["register"], options["radiomics"], region_executor, options["retry_failed"])))
+
+    print(f"[INFO] Starting pipeline for {len(tasks)} subjects.")
+    # Retry runs must always execute, never be served from stored subject results
+    outcomes = executor.run(run_pipeline, tasks, reuse=not args.retry_failed)
+
+    # Failure report: failed subjects, then the failed regions of each completed subject
+    result_csvs = [result for _, result, error, _ in outcomes if error is None and result]
+    failed = [(key, error) for key, _, error, _ in outcomes if error is not None]
+    cohort_failures = []
+    for (key, task_args), (_, _, error, _) in zip(tasks, outcomes):
+        if error is not None:
+            print(f"[ERROR] Subject task '{key}' failed: {error}")
+            cohort_failures.append({"key": key, "image": task_args[0], "results_csv": None, "Source": None,
+                                    "region_name": None, "error": error})
+            continue
+        # Region `row`s index the subject results CSV, which each entry names explicitly
+        image_name = get_image_name(task_args[0])
+        subject_failures = task_args[1] / f"{image_name}_failures.json"
+        if subject_failures.exists():
+            results_csv = str(task_args[1] / f"{image_name}_results.csv")
+            with open(subject_failures, "r") as f:
+                cohort_failures.extend({**failure, "results_csv": results_csv} for failure in json.load(f))
+
+    if result_csvs:
+        build_cohort_table(result_csvs, output_dir / "cohort_results.csv")
+    cohort_failures_json = output_dir / "cohort_failures.json"
+    if cohort_failures:
+        with open(cohort_failures_json, "w") as f:
+            json.dump(cohort_failures, f, indent=4)
+        print(f"[WARNING] {len(cohort_failures)} subjects or regions failed. Failure report saved to "
+              f"{cohort_failures_json}. Re-run with --retry-failed yes to only retry them.")
+    else:
+        cohort_failures_json.unlink(missing_ok=True)
+    if failed:
+        raise RuntimeError(f"[ERROR] {len(failed)} of {len(tasks)} subjects failed.")
+    print(f"[INFO] Pipeline completed successfully for {len(tasks)} subjects. Results saved to {output_dir}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file